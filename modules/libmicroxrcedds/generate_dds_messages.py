@@ -8,21 +8,43 @@ Micro XRCE-DDS智能生成脚本
 """
 
 import argparse
+import asyncio
+import functools
+import itertools
+import operator
 import os
 import re
+import shutil
 import subprocess
 import sys
 import pathlib
 import logging
 from collections import defaultdict
-from typing import List, Dict, Tuple, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, List, Dict, Tuple, Optional
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('uxr-generator')
 
+# microxrceddsgen绝对路径，模块加载时解析一次。
+# 使用绝对路径并配合close_fds=False等条件，CPython会用posix_spawn代替fork+exec启动子进程
+MICROXRCEDDSGEN = shutil.which('microxrceddsgen')
+
+# IDL中的 #include "<package>/msg/<Type>.idl"
+_INCLUDE_RE = re.compile(rb'#include\s*[<"]([^">]+)[">]')
+
+# 消息列表文件的行格式
+# [^\S\n] 匹配除换行外的任意空白 (含全角空格、不间断空格、\r等)，与str.strip()一致
+_MSG_RE = re.compile(
+    r'^[^\S\n]*(?:([A-Za-z_]\w*)[^\S\n]*/[^\S\n]*([A-Za-z_]\w*)[^\S\n]*(?:#.*)?|#.*|(\S.*?))?[^\S\n]*$',
+    re.MULTILINE
+)
+
 class IdlGenerator:
     """IDL生成器配置类"""
+    __slots__ = ('package', 'msg_type', 'idl_path', 'h_name', 'c_name', 'rel_dir')
+    
     def __init__(self, package: str, msg_type: str, idl_path: pathlib.Path):
         """
         :param package: ROS 2包名 (如'sensor_msgs')
@@ -33,18 +55,33 @@ class IdlGenerator:
         self.msg_type = msg_type
         self.idl_path = idl_path
         
-        # 生成的文件名 (小写格式，符合ROS 2命名规范)
-        self.h_name = f"{self.msg_type.lower()}.h"
-        self.c_name = f"{self.msg_type.lower()}.c"
+        # 生成的文件名 (-cs模式下与IDL文件名大小写一致，如Header.h)
+        self.h_name = f"{self.msg_type}.h"
+        self.c_name = f"{self.msg_type}.c"
         
-        # 生成文件的相对路径
-        self.rel_dir = pathlib.Path(self.package) / "msg"
+        # 生成文件的相对路径 (保存为字符串，需要时再构造Path)
+        self.rel_dir = f"{package}/msg"
     
     def __repr__(self):
         return f"<IdlGenerator {self.package}/{self.msg_type} at {self.idl_path}>"
 
+@functools.lru_cache(maxsize=None)
 def find_ros_share_dir(package: str) -> pathlib.Path:
-    """查找ROS 2包的share目录"""
+    """查找ROS 2包的share目录 (结果缓存，同一包只查询一次)"""
+    # 与ament_index一致：依次在AMENT_PREFIX_PATH各前缀下查找share/<package>/package.xml，
+    # 避免每次都启动ros2命令行 (需导入整个rclpy/ament栈)
+    ament_prefix_path = os.environ.get('AMENT_PREFIX_PATH')
+    if ament_prefix_path:
+        for prefix in ament_prefix_path.split(os.pathsep):
+            if not prefix:
+                continue
+            candidate = pathlib.Path(prefix) / "share" / package
+            if (candidate / "package.xml").exists():
+                return candidate
+        logger.error(f"Package '{package}' not found in AMENT_PREFIX_PATH. Is it installed?")
+        raise FileNotFoundError(f"Package '{package}' not found")
+    
+    # 未source ROS 2环境时回退到ros2命令行
     try:
         result = subprocess.run(
             ['ros2', 'pkg', 'prefix', '--share', package],
@@ -62,6 +99,18 @@ def find_ros_share_dir(package: str) -> pathlib.Path:
         logger.error(f"Error locating share dir for {package}: {str(e)}")
         raise
 
+def _resolve_share_dirs(packages: Iterable[str]) -> Dict[str, Future]:
+    """并发查询多个包的share目录，返回 {包名: 已完成的Future}，查询异常保留在Future中"""
+    if not packages:
+        return {}
+    
+    # 回退到ros2命令行时每次查询都要启动一个进程，并发查询以重叠等待时间
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        return {
+            package: ex.submit(find_ros_share_dir, package)
+            for package in packages
+        }
+
 def parse_message_list(message_file: pathlib.Path) -> Dict[str, List[str]]:
     """
     解析消息列表文件
@@ -73,51 +122,44 @@ def parse_message_list(message_file: pathlib.Path) -> Dict[str, List[str]]:
     if not message_file.exists():
         raise FileNotFoundError(f"Message list file not found: {message_file}")
     
-    package_msgs = defaultdict(list)
+    # 使用集合去重，避免同一消息被重复生成
+    package_msgs: Dict[str, set] = defaultdict(set)
     
-    with open(message_file, 'r') as f:
-        for line in f:
-            line = line.strip()
-            # 跳过空行和注释
-            if not line or line.startswith('#'):
-                continue
-            
-            # 验证格式: <package>/<msg_type>
-            if '/' not in line:
-                logger.warning(f"Invalid message format: {line}. Skipping.")
-                continue
-            
-            package, msg_type = line.split('/', 1)
-            package = package.strip()
-            msg_type = msg_type.strip()
-            
-            if not package or not msg_type:
-                logger.warning(f"Invalid message format: {line}. Skipping.")
-                continue
-                
-            package_msgs[package].append(msg_type)
+    # 对整个文件做一次正则扫描，每行匹配其一：
+    # <package>/<msg_type> ("/"两侧允许空白，可带行尾注释)、注释行、空行；其余内容落入第3组作为无效行
+    for m in _MSG_RE.finditer(message_file.read_text()):
+        package, msg_type, invalid = m.groups()
+        if invalid:
+            logger.warning(f"Invalid message format: {invalid}. Skipping.")
+        elif package:
+            package_msgs[package].add(msg_type)
     
-    return package_msgs
+    return {package: sorted(msg_types) for package, msg_types in package_msgs.items()}
 
 def locate_idl_files(package_msgs: Dict[str, List[str]]) -> List[IdlGenerator]:
     """定位所有IDL文件"""
     idl_generators = []
     missing_packages = []
     
+    share_dir_futures = _resolve_share_dirs(package_msgs)
+    
     for package, msg_types in package_msgs.items():
         try:
-            share_dir = find_ros_share_dir(package)
+            share_dir = share_dir_futures[package].result()
             msg_dir = share_dir / "msg"
             
             if not msg_dir.exists():
                 logger.warning(f"No 'msg' directory found for package {package} at {msg_dir}")
                 continue
                 
+            # 一次读取目录内容，代替对每个消息单独stat
+            available = {p.stem: p for p in msg_dir.iterdir() if p.suffix == '.idl'}
+            
             for msg_type in msg_types:
-                idl_path = msg_dir / f"{msg_type}.idl"
+                idl_path = available.get(msg_type)
                 
-                if not idl_path.exists():
-                    logger.warning(f"IDL file not found: {idl_path}")
+                if idl_path is None:
+                    logger.warning(f"IDL file not found: {msg_dir / f'{msg_type}.idl'}")
                     continue
                     
                 idl_generators.append(IdlGenerator(package, msg_type, idl_path))
@@ -131,7 +173,172 @@ def locate_idl_files(package_msgs: Dict[str, List[str]]) -> List[IdlGenerator]:
     
     return idl_generators
 
-def generate_uxr_code(
+def _fresh(gen: IdlGenerator, pkg_output_dir: pathlib.Path, replace: bool) -> bool:
+    """判断生成的.h/.c是否比源IDL文件新 (无需重新生成)"""
+    try:
+        h_mtime = os.stat(pkg_output_dir / gen.h_name).st_mtime
+        c_mtime = os.stat(pkg_output_dir / gen.c_name).st_mtime
+    except FileNotFoundError:
+        return False
+    
+    # 不替换现有文件时，microxrceddsgen也不会覆盖它们，已存在即视为最新
+    if not replace:
+        return True
+    
+    return min(h_mtime, c_mtime) > os.stat(gen.idl_path).st_mtime
+
+def collect_include_roots(idl_generators: List[IdlGenerator]) -> List[pathlib.Path]:
+    """
+    解析IDL的#include依赖 (递归)，返回所有相关包的share根目录，供-I使用
+    依赖的消息若不在消息列表中会给出警告，因为生成的头文件会引用它
+    """
+    requested = {(gen.package, gen.msg_type) for gen in idl_generators}
+    include_roots = []
+    seen = set()
+    pending = [gen.idl_path for gen in idl_generators]
+    
+    # 已解析的包share目录，以及无法解析的包 (只查询、只警告一次)
+    share_dirs = {gen.package: gen.idl_path.parent.parent for gen in idl_generators}
+    failed_packages = set()
+    
+    # 按轮次展开依赖：读取本轮IDL的#include，再并发解析本轮新出现的依赖包
+    while pending:
+        includes = []
+        for idl_path in pending:
+            if idl_path in seen:
+                continue
+            seen.add(idl_path)
+            
+            share_root = idl_path.parent.parent.parent
+            if share_root not in include_roots:
+                include_roots.append(share_root)
+            
+            try:
+                found = _INCLUDE_RE.findall(idl_path.read_bytes())
+            except OSError as e:
+                logger.warning(f"Failed to read {idl_path}: {str(e)}")
+                continue
+            
+            for include in found:
+                dep_package, sep, dep_rel = include.decode().partition('/')
+                if sep:
+                    includes.append((idl_path, dep_package, dep_rel))
+        
+        pending = []
+        new_packages = {dep_package for _, dep_package, _ in includes} - share_dirs.keys() - failed_packages
+        for package, future in _resolve_share_dirs(new_packages).items():
+            try:
+                share_dirs[package] = future.result()
+            except Exception:
+                logger.warning(f"Cannot resolve dependency package '{package}', skipping its includes")
+                failed_packages.add(package)
+        
+        for idl_path, dep_package, dep_rel in includes:
+            if dep_package in failed_packages:
+                continue
+            
+            dep_msg = (dep_package, pathlib.PurePosixPath(dep_rel).stem)
+            if dep_msg not in requested:
+                logger.warning(
+                    f"{idl_path.stem} depends on {dep_msg[0]}/{dep_msg[1]}, "
+                    "which is not in the message list"
+                )
+                requested.add(dep_msg)
+            pending.append(share_dirs[dep_package] / dep_rel)
+    
+    return include_roots
+
+async def _run_one_package(
+    package: str,
+    generators: List[IdlGenerator],
+    output_dir: pathlib.Path,
+    common_args: List[str],
+    replace: bool,
+    limit: asyncio.Semaphore,
+) -> Tuple[str, List[pathlib.Path]]:
+    """
+    为单个包调用microxrceddsgen，返回 (包名, 生成的文件列表)
+    :param common_args: 所有包共用的参数 (-cs/-replace/-I等)，由调用方构建一次
+    """
+    logger.info(f"Processing package: {package}")
+    generated_files = []
+    
+    # 包输出目录已由generate_uxr_code预先创建
+    pkg_output_dir = output_dir / package / "msg"
+    
+    try:
+        # 只为过期的消息重新生成 (增量构建)
+        stale = [gen for gen in generators if not _fresh(gen, pkg_output_dir, replace)]
+        
+        if stale:
+            # 收集此包需要生成的IDL文件
+            idl_files = [str(gen.idl_path) for gen in stale]
+            
+            # 构建命令行参数：共用参数 + 本包输出目录 + IDL文件
+            cmd = [MICROXRCEDDSGEN, *common_args, '-d', str(pkg_output_dir), *idl_files]
+            
+            # 生成器的标准输出只在调试时有用，其余情况直接丢弃，不在内存中缓存
+            debug = logger.isEnabledFor(logging.DEBUG)
+            out_pipe = asyncio.subprocess.PIPE if debug else asyncio.subprocess.DEVNULL
+            if debug:
+                logger.debug("Running command: %s", ' '.join(cmd))
+            
+            # 执行生成命令 (异步等待，其他包的子进程与后处理可同时进行)
+            async with limit:
+                # 不设置preexec_fn/cwd等参数并关闭close_fds，CPython才会走posix_spawn快速路径。
+                # 代价：本脚本从父进程继承来的可继承fd (如make/ninja jobserver、CI管道)
+                # 也会传给每个microxrceddsgen；Python自身创建的fd默认不可继承，不受影响
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd, stdout=out_pipe, stderr=asyncio.subprocess.PIPE,
+                    close_fds=False
+                )
+                stdout, stderr = await proc.communicate()
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(
+                    proc.returncode, cmd,
+                    stdout.decode(errors='replace') if stdout is not None else None,
+                    stderr.decode(errors='replace')
+                )
+            if debug:
+                logger.debug("Generation output for %s:\n%s", package, stdout.decode(errors='replace'))
+        
+        # 记录生成的文件 (每个包汇总为一条日志)
+        # 一次读取输出目录，代替对每个文件单独stat
+        with os.scandir(pkg_output_dir) as it:
+            produced = {entry.name for entry in it}
+        
+        # 仅列出本次实际生成的文件，已是最新的只计数
+        stale_set = set(stale)
+        gens_rel = []
+        fresh_count = 0
+        for gen in generators:
+            if gen.h_name in produced and gen.c_name in produced:
+                if gen in stale_set:
+                    gens_rel.append(gen.h_name)
+                    gens_rel.append(gen.c_name)
+                else:
+                    fresh_count += 2
+                generated_files.append(pkg_output_dir / gen.h_name)
+                generated_files.append(pkg_output_dir / gen.c_name)
+            else:
+                logger.warning(f"Missing generated files for {package}/{gen.msg_type}")
+        
+        if gens_rel and logger.isEnabledFor(logging.INFO):
+            logger.info("Generated %d files for %s: %s", len(gens_rel), package, ', '.join(gens_rel))
+        if fresh_count:
+            logger.info("Package %s: %d files up to date, skipped generation", package, fresh_count)
+        
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Failed to generate code for package {package}")
+        logger.error(f"Command: {' '.join(e.cmd)}")
+        logger.error(f"Error code: {e.returncode}")
+        logger.error(f"Stderr:\n{e.stderr}")
+    except Exception as e:
+        logger.error(f"Unexpected error generating code for {package}: {str(e)}")
+    
+    return package, generated_files
+
+async def generate_uxr_code(
     idl_generators: List[IdlGenerator],
     output_dir: pathlib.Path,
     include_paths: List[pathlib.Path] = None,
@@ -139,74 +346,50 @@ def generate_uxr_code(
     # container_prealloc_size: int = 4
 ):
     """生成Micro XRCE-DDS代码"""
-    # 按包分组
-    package_groups = defaultdict(list)
-    for gen in idl_generators:
-        package_groups[gen.package].append(gen)
+    # 按包分组。groupby要求同一包的生成器连续，先做稳定排序，
+    # 否则同一包会被拆成多组并发写入同一输出目录 (包内消息顺序保持不变)
+    by_package = operator.attrgetter('package')
+    package_groups = [
+        (package, list(generators))
+        for package, generators in itertools.groupby(sorted(idl_generators, key=by_package), key=by_package)
+    ]
     
-    # 确保输出目录存在
+    # 确保输出目录存在，并在并发生成前一次性创建所有包的输出目录
     output_dir.mkdir(parents=True, exist_ok=True)
+    for package, _ in package_groups:
+        (output_dir / package / "msg").mkdir(parents=True, exist_ok=True)
     
     # 收集所有生成的源文件路径
     generated_files = []
     
-    for package, generators in package_groups.items():
-        logger.info(f"Processing package: {package}")
-        
-        # 为包创建输出目录
-        pkg_output_dir = output_dir / package / "msg"
-        pkg_output_dir.mkdir(parents=True, exist_ok=True)
-        
-        # 收集此包的所有IDL文件
-        idl_files = [str(gen.idl_path) for gen in generators]
-        
-        # 构建命令行参数
-        cmd = [
-            'microxrceddsgen',
-            '-cs',  # case sensitive
-            '-replace' if replace else '',
-            # f'-default-container-prealloc-size={container_prealloc_size}',
-            '-d', str(pkg_output_dir),
-        ]
-        
-        # 添加包含路径
-        if include_paths:
-            for path in include_paths:
-                cmd.extend(['-I', str(path)])
-        
-        # 添加IDL文件
-        cmd.extend(idl_files)
-        
-        # 过滤空参数
-        cmd = [arg for arg in cmd if arg]
-        
-        logger.debug(f"Running command: {' '.join(cmd)}")
-        
-        try:
-            # 执行生成命令
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            logger.debug(f"Generation output for {package}:\n{result.stdout}")
-            
-            # 记录生成的文件
-            for gen in generators:
-                h_file = pkg_output_dir / gen.h_name
-                c_file = pkg_output_dir / gen.c_name
-                
-                if h_file.exists() and c_file.exists():
-                    logger.info(f"Generated: {h_file.relative_to(output_dir)}")
-                    logger.info(f"Generated: {c_file.relative_to(output_dir)}")
-                    generated_files.append(h_file)
-                    generated_files.append(c_file)
-                else:
-                    logger.warning(f"Missing generated files for {package}/{gen.msg_type}")
-            
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Failed to generate code for package {package}")
-            logger.error(f"Command: {' '.join(e.cmd)}")
-            logger.error(f"Error code: {e.returncode}")
-            logger.error(f"Stderr:\n{e.stderr}")
-        except Exception as e:
-            logger.error(f"Unexpected error generating code for {package}: {str(e)}")
+    if not package_groups:
+        return generated_files
+    
+    # ROS 2的IDL以 "<package>/msg/<Type>.idl" 形式互相引用，
+    # 把所有相关包 (含依赖包) 的share根目录加入包含路径，使跨包依赖能被解析
+    shared_includes = list(include_paths or [])
+    for share_root in collect_include_roots(idl_generators):
+        if share_root not in shared_includes:
+            shared_includes.append(share_root)
+    
+    # 所有包共用的参数只构建一次
+    common_args = ['-cs']  # case sensitive
+    if replace:
+        common_args.append('-replace')
+    # common_args.append(f'-default-container-prealloc-size={container_prealloc_size}')
+    for path in shared_includes:
+        common_args.extend(['-I', str(path)])
+    
+    # 各包输出目录互不相关，并行调用microxrceddsgen以掩盖JVM启动耗时，
+    # 同时运行的JVM数量不超过CPU核数
+    limit = asyncio.Semaphore(os.cpu_count() or 1)
+    results = await asyncio.gather(*[
+        _run_one_package(package, generators, output_dir, common_args, replace, limit)
+        for package, generators in package_groups
+    ])
+    for package, files in results:
+        logger.info(f"Finished package: {package} ({len(files)} files)")
+        generated_files.extend(files)
     
     return generated_files
 
@@ -257,6 +440,10 @@ def main():
     if args.verbose:
         logger.setLevel(logging.DEBUG)
     
+    if MICROXRCEDDSGEN is None:
+        logger.error("microxrceddsgen not found in PATH. Is it installed?")
+        sys.exit(1)
+    
     # 1. 解析消息列表
     logger.info(f"Parsing message list: {args.message_file}")
     try:
@@ -283,13 +470,13 @@ def main():
     
     # 3. 生成代码
     logger.info(f"Generating code to: {args.output}")
-    generated_files = generate_uxr_code(
+    generated_files = asyncio.run(generate_uxr_code(
         idl_generators,
         args.output,
         include_paths=args.include,
         replace=args.replace,
         # container_prealloc_size=args.container_prealloc_size
-    )
+    ))
     
     # 4. 输出结果
     logger.info("\nGeneration completed!")